@@ -10,11 +10,16 @@ from moviepy.editor import ImageClip, concatenate_videoclips
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 
 def load_conversation(conversation_file):
     try:
-        with open(conversation_file, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(conversation_file, "rb") as f:
+            return json_loads(f.read())
     except Exception as e:
         logging.error(f"Error loading {conversation_file}: {e}")
         return None
@@ -59,7 +64,7 @@ def flatten_durations(conversation):
     return durations
 
 
-def create_video(flat_list, output_video, image_dir):
+def create_video(flat_list, output_video, image_dir, preset="ultrafast", threads=None):
     os.makedirs(os.path.dirname(output_video) or ".", exist_ok=True)
 
     # Grab video frames in lexical order (0001.png, 0002.png, …)
@@ -79,9 +84,15 @@ def create_video(flat_list, output_video, image_dir):
     for img_path, dur in zip(frames, flat_list):
         clips.append(ImageClip(img_path).set_duration(dur))
 
-    video = concatenate_videoclips(clips, method="compose")
+    # "chain" only works when every frame has the same size
+    method = "chain" if len({c.size for c in clips}) == 1 else "compose"
+    video = concatenate_videoclips(clips, method=method)
     try:
-        video.write_videofile(output_video, fps=24)
+        # still slides: all cores, x264 stillimage tuning, index at the front
+        video.write_videofile(output_video, fps=24, preset=preset,
+                              threads=threads or os.cpu_count(),
+                              ffmpeg_params=["-crf", "23", "-tune", "stillimage",
+                                             "-movflags", "+faststart"])
         logging.info(f"Video saved as {output_video}")
     except Exception as e:
         logging.error(f"Failed to write video: {e}")
@@ -102,6 +113,14 @@ def main():
         "--output", default="video/conversation_video.mp4",
         help="Destination for the rendered video."
     )
+    parser.add_argument(
+        "--preset", default="ultrafast",
+        help="libx264 preset; slower presets give smaller files."
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None,
+        help="Encoder threads (defaults to the CPU count)."
+    )
     args = parser.parse_args()
 
     conv = load_conversation(args.conversation)
@@ -109,7 +128,7 @@ def main():
         sys.exit(1)
 
     durations = flatten_durations(conv)
-    create_video(durations, args.output, args.image_dir)
+    create_video(durations, args.output, args.image_dir, args.preset, args.threads)
 
 
 if __name__ == "__main__":
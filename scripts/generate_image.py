@@ -6,8 +6,9 @@ import re
 import logging
 import sys
 import argparse
-import copy
 from datetime import datetime
+from io import BytesIO
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from pilmoji import Pilmoji
 from pilmoji.source import GoogleEmojiSource
@@ -20,14 +21,52 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(me
 # -----------------------------------------------------------------------------
 # JSON Loader
 # -----------------------------------------------------------------------------
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 def load_json(path):
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(path, 'rb') as f:
+            return json_loads(f.read())
     except Exception as e:
         logging.error(f"Failed loading {path}: {e}")
         return None
 
+# -----------------------------------------------------------------------------
+# Emoji Source
+# -----------------------------------------------------------------------------
+EMOJI_CACHE_DIR = os.path.join('.cache', 'emoji')
+
+class CachedGoogleEmojiSource(GoogleEmojiSource):
+    """GoogleEmojiSource that remembers downloaded PNGs in memory and on disk."""
+    _CACHE = {}
+
+    def get_emoji(self, emoji, /):
+        data = self._CACHE.get(emoji)
+        if data is None and emoji not in self._CACHE:
+            path = os.path.join(EMOJI_CACHE_DIR, "-".join(f"{ord(c):x}" for c in emoji) + ".png")
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+            else:
+                stream = super().get_emoji(emoji)
+                if stream is not None:
+                    data = stream.getvalue()
+                    try:
+                        os.makedirs(EMOJI_CACHE_DIR, exist_ok=True)
+                        with open(path, 'wb') as f:
+                            f.write(data)
+                    except OSError as e:
+                        logging.warning(f"Could not cache emoji {emoji!r}: {e}")
+            # misses are remembered too so they are only requested once per run
+            self._CACHE[emoji] = data
+        return BytesIO(data) if data is not None else None
+
+# one shared instance so every Pilmoji context reuses the same source
+EMOJI_SOURCE = CachedGoogleEmojiSource()
+
 # -----------------------------------------------------------------------------
 # Markdown + Emoji Drawing Helpers
 # -----------------------------------------------------------------------------
@@ -193,18 +232,8 @@ def merge_config(role, cfg):
 # -----------------------------------------------------------------------------
 # Message Block (no saving!)
 # -----------------------------------------------------------------------------
-def generate_message_block(messages, role, cfg):
-    c     = merge_config(role, cfg)
-    bg    = c['background_color']
-    fg    = c['text_color']
-    uname_col = c['username_color']
-    W     = c['block_width']
-    av    = c['profile_size']
-    px, py = c['horizontal_padding'], c['vertical_padding']
-    gap, ls = c['profile_gap'], c['line_spacing']
-
+def block_timestamp(first):
     now = datetime.now()
-    first = messages[0]
     ts = now.strftime("Today at %-I:%M %p")
     if 'timestamp' in first:
         try:
@@ -214,7 +243,9 @@ def generate_message_block(messages, role, cfg):
             pass
     if first.get('edited', False):
         ts += " (edited)"
+    return ts
 
+def load_block_fonts(c):
     fp, bfp = c['font_path'], c.get('bold_font_path', c['font_path'])
     sz = c.get('font_size', 24)
     try:
@@ -224,28 +255,30 @@ def generate_message_block(messages, role, cfg):
         emoji_font = ImageFont.truetype(fp, sz-6)
     except IOError:
         font = bold = ts_font = emoji_font = ImageFont.load_default()
-
-    dummy = Image.new('RGB', (W,1000), bg)
-    dd = ImageDraw.Draw(dummy)
-    max_w = W - (px*2 + av + gap)
-    all_lines = []
-    for seg in messages:
-        text = re.sub(r'\[SFX:[^\]]+\]', '', seg['text'])
-        tokens = parse_markdown(text)
-        lines = wrap_tokens(tokens, dd, {'normal': font, 'bold': bold, 'italic': font, 'bold_italic': bold}, max_w)
-        all_lines.extend(lines)
+    return font, bold, ts_font, emoji_font
+
+def render_header(messages, role, cfg):
+    """
+    Render the avatar + username + timestamp band of a message block. It is the
+    same for every typing frame of an entry, so callers can build it once and
+    pass it to generate_message_block.
+    """
+    c     = merge_config(role, cfg)
+    W     = c['block_width']
+    av    = c['profile_size']
+    px, py = c['horizontal_padding'], c['vertical_padding']
+    gap   = c['profile_gap']
+    fp    = c['font_path']
+    _, bold, ts_font, _ = load_block_fonts(c)
+    ts    = block_timestamp(messages[0])
 
     name_h = bold.getbbox("Ag")[3]
-    text_h = len(all_lines) * (name_h + ls)
-    link = extract_first_url("\n".join(m['text'] for m in messages))
-    link_h = 50 if link else 0
-    reactions = first.get('reactions', [])
-    react_h = 30 if reactions else 0
-    H = max(av + 2*py, name_h + text_h + link_h + react_h + 2*py)
-
-    img = Image.new('RGBA', (W, int(H)), (0,0,0,0))
-    dr  = ImageDraw.Draw(img)
-    dr.rounded_rectangle((0,0,W,H), radius=8, fill=bg)
+    Hh = py + max(av, name_h + 4)
+    strip = Image.new('RGBA', (W, Hh), (0,0,0,0))
+    dr    = ImageDraw.Draw(strip)
+    # same rounded background as the block (bottom corners fall outside the
+    # strip), so pasting it over the block's top edge is pixel-identical
+    dr.rounded_rectangle((0,0,W,Hh+16), radius=8, fill=c['background_color'])
 
     if c.get('profile_image_path') and os.path.exists(c['profile_image_path']):
         try:
@@ -264,14 +297,54 @@ def generate_message_block(messages, role, cfg):
     ImageDraw.Draw(mask).ellipse((bw,bw,HR-bw,HR-bw), fill=255)
     border.paste(av_img.resize((HR,HR), Image.LANCZOS), (0,0), mask)
     avatar = border.resize((av,av), Image.LANCZOS)
-    img.paste(avatar, (px, py), avatar)
+    strip.paste(avatar, (px, py), avatar)
 
     x0, y0 = px + av + gap, py
-    dr.text((x0, y0), c.get('profile_name','?'), font=bold, fill=uname_col)
+    dr.text((x0, y0), c.get('profile_name','?'), font=bold, fill=c['username_color'])
     n_w = dr.textlength(c.get('profile_name','?'), font=bold)
     dr.text((x0 + n_w + 8, y0 + 2), ts, font=ts_font, fill="gray")
+    return strip
+
+def generate_message_block(messages, role, cfg, header_img=None):
+    c     = merge_config(role, cfg)
+    bg    = c['background_color']
+    fg    = c['text_color']
+    W     = c['block_width']
+    av    = c['profile_size']
+    px, py = c['horizontal_padding'], c['vertical_padding']
+    gap, ls = c['profile_gap'], c['line_spacing']
+    first = messages[0]
+
+    font, bold, _, emoji_font = load_block_fonts(c)
+
+    dummy = Image.new('RGB', (W,1000), bg)
+    dd = ImageDraw.Draw(dummy)
+    max_w = W - (px*2 + av + gap)
+    all_lines = []
+    for seg in messages:
+        text = re.sub(r'\[SFX:[^\]]+\]', '', seg['text'])
+        tokens = parse_markdown(text)
+        lines = wrap_tokens(tokens, dd, {'normal': font, 'bold': bold, 'italic': font, 'bold_italic': bold}, max_w)
+        all_lines.extend(lines)
+
+    name_h = bold.getbbox("Ag")[3]
+    text_h = len(all_lines) * (name_h + ls)
+    link = extract_first_url("\n".join(m['text'] for m in messages))
+    link_h = 50 if link else 0
+    reactions = first.get('reactions', [])
+    react_h = 30 if reactions else 0
+    H = max(av + 2*py, name_h + text_h + link_h + react_h + 2*py)
+
+    img = Image.new('RGBA', (W, int(H)), (0,0,0,0))
+    dr  = ImageDraw.Draw(img)
+    dr.rounded_rectangle((0,0,W,H), radius=8, fill=bg)
+
+    if header_img is None:
+        header_img = render_header(messages, role, cfg)
+    img.paste(header_img, (0,0))
 
-    with Pilmoji(img, source=GoogleEmojiSource) as pilmoji:
+    x0, y0 = px + av + gap, py
+    with Pilmoji(img, source=EMOJI_SOURCE) as pilmoji:
         y_text = y0 + name_h + 4
         draw_markdown_lines(dr, pilmoji, all_lines, x0, y_text, ls, fg, 
                             {'normal': font, 'bold': bold, 'italic': font, 'bold_italic': bold})
@@ -302,17 +375,18 @@ def generate_join_or_leave_message(name, time, template, arrow_x, arrow_img, col
     arr = Image.open(arrow_img).convert('RGBA')
     arr.thumbnail((40,40), Image.LANCZOS)
     ascent,_ = msg_f.getmetrics()
-    txt_h = msg_f.getbbox("Ag")[3] - msg_f.getbbox("Ag")[1]
+    ag_bb = msg_f.getbbox("Ag")
+    txt_h = ag_bb[3] - ag_bb[1]
     y0 = (H - txt_h)//2
     ay = y0 + (ascent - arr.height)//2
     img.paste(arr, (arrow_x, ay), arr)
     x0 = arrow_x + arr.width + 60
-    with Pilmoji(img, source=GoogleEmojiSource) as pilmoji:
+    with Pilmoji(img, source=EMOJI_SOURCE) as pilmoji:
         pilmoji.text((x0, y0), before, cfg["default"].get("joined_font_color", "#e0e0e0"), font=msg_f)
-        nx = x0 + msg_f.getbbox(before)[2]
+        nx = x0 + int(msg_f.getlength(before))
         pilmoji.text((nx, y0), name, color, font=name_f)
-        pilmoji.text((nx + name_f.getbbox(name)[2], y0), after, cfg["default"].get("joined_font_color", "#e0e0e0"), font=msg_f)
-        dr.text((nx + msg_f.getbbox(before+name+after)[2] + 30, y0), time_str, font=time_f, fill=cfg["default"].get("time_font_color", "#888"))
+        pilmoji.text((nx + int(name_f.getlength(name)), y0), after, cfg["default"].get("joined_font_color", "#e0e0e0"), font=msg_f)
+        dr.text((nx + int(msg_f.getlength(before+name+after)) + 30, y0), time_str, font=time_f, fill=cfg["default"].get("time_font_color", "#888"))
     return img
 
 # -----------------------------------------------------------------------------
@@ -352,30 +426,33 @@ def iter_message_blocks(entry, cfg):
     role     = entry.get('role')
     messages = entry.get('messages', [])
 
+    full = [dict(messages[0]), *messages[1:]]
+    for flag in ('timestamp','edited'):
+        if flag in entry:
+            full[0][flag] = entry[flag]
+    # avatar/name/timestamp don't change while the entry builds up
+    header = render_header(full, role, cfg)
+
     # typing build-up
     for count in range(1, len(messages)):
-        subset = copy.deepcopy(messages[:count])
+        # only the first message is mutated, so copy just that one
+        subset = [dict(messages[0]), *messages[1:count]]
         for flag in ('timestamp','edited'):
             if flag in entry:
                 subset[0][flag] = entry[flag]
         subset[0].pop('reactions', None)
-        yield generate_message_block(subset, role, cfg)
+        yield generate_message_block(subset, role, cfg, header)
 
     # full + reactions
-    full = copy.deepcopy(messages)
-    for flag in ('timestamp','edited'):
-        if flag in entry:
-            full[0][flag] = entry[flag]
-
     state = {}
     for ev in entry.get('reactions', []):
         state[ev['emoji']] = ev['count']
         full[0]['reactions'] = [{"emoji": e, "count": state[e]} for e in state]
-        yield generate_message_block(full, role, cfg)
+        yield generate_message_block(full, role, cfg, header)
 
     if not entry.get('reactions'):
         full[0].pop('reactions', None)
-        yield generate_message_block(full, role, cfg)
+        yield generate_message_block(full, role, cfg, header)
 
 def iter_all_images(conv, cfg):
     for entry in conv.get('conversation', []):
@@ -384,6 +461,11 @@ def iter_all_images(conv, cfg):
         else:
             yield from iter_message_blocks(entry, cfg)
 
+def iter_frame_arrays(conv, cfg):
+    """Yield every frame as a contiguous RGB array that moviepy's ImageClip accepts directly."""
+    for img in iter_all_images(conv, cfg):
+        yield np.ascontiguousarray(np.asarray(img.convert('RGB')))
+
 # -----------------------------------------------------------------------------
 # Main
 # -----------------------------------------------------------------------------
@@ -399,11 +481,14 @@ def main():
         sys.exit(1)
 
     os.makedirs('video', exist_ok=True)
-    for idx, img in enumerate(iter_all_images(conv, cfg), start=1):
-        filename = f"{idx:04d}.png"
+    count = 0
+    for count, img in enumerate(iter_all_images(conv, cfg), start=1):
+        filename = f"{count:04d}.png"
         path     = os.path.join('video', filename)
-        img.save(path)
-        logging.info(f"Saved: {path}")
+        # Frames are re-encoded by ffmpeg later, so favour write speed over size
+        img.save(path, 'PNG', compress_level=1, optimize=False)
+        logging.debug(f"Saved: {path}")
+    logging.info(f"Saved {count} frames to video/")
 
 if __name__ == '__main__':
     main()
@@ -2,55 +2,158 @@
 
 import json
 import os
-import time
+import sys
 import shutil
 import logging
 import argparse
 import glob
-import emoji
+import gc
+import hashlib
+import subprocess
 import re
+import contextlib
+import multiprocessing
 import numpy as np
 import soundfile as sf
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
 from moviepy.editor import (
     ImageClip,
-    concatenate_videoclips,
-    AudioFileClip,
-    CompositeAudioClip
+    concatenate_videoclips
 )
-from kokoro import KPipeline
+from moviepy.audio.AudioClip import AudioArrayClip
+from moviepy.config import get_setting
+from PIL import Image
+# lets Kokoro fall back to the CPU for the few ops Metal lacks; must be set
+# before torch is imported
+os.environ.setdefault("PYTORCH_ENABLE_MPS_FALLBACK", "1")
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+# prefer orjson when installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 AUDIO_DIR    = "audio"
 VIDEO_DIR    = "video"
 OUTPUT_VIDEO = "output/final_video.mp4"
 CONV_FILE    = "utils/conversation.json"
 CONFIG_FILE  = "utils/config.json"
+# outside AUDIO_DIR so --cleanup keeps it between runs
+TTS_CACHE_DIR     = os.path.join(".cache", "tts")
+SEGMENT_CACHE_DIR = os.path.join(".cache", "segments")
+
+# Kokoro TTS (only for non-system text); the model is loaded on first use
+LANG_CODE = 'a'
+
+@lru_cache(maxsize=1)
+def tts_device():
+    import torch
+    if torch.cuda.is_available():
+        return "cuda"
+    mps = getattr(torch.backends, "mps", None)
+    if mps is not None and mps.is_available():
+        return "mps"
+    return "cpu"
+
+@lru_cache(maxsize=1)
+def _get_pipeline():
+    # kokoro pulls in torch; only runs that actually synthesize pay for the import
+    from kokoro import KPipeline
+    return KPipeline(lang_code=LANG_CODE, device=tts_device())
+
+
+def _pipeline_with_voice(voice):
+    """
+    Return the pipeline with `voice` loaded onto the model's device. Kokoro
+    caches packs on the CPU and copies them over on every call; storing the
+    device copy in its cache makes that a no-op.
+    """
+    pipeline = _get_pipeline()
+    pack = pipeline.load_voice(voice)
+    if pipeline.model is not None and pack.device != pipeline.model.device:
+        pipeline.voices[voice] = pack.to(pipeline.model.device)
+    return pipeline
 
-# Kokoro TTS (only for non-system text)
-pipeline = KPipeline(lang_code='a')
+
+def release_pipeline():
+    """Drop the Kokoro model once speech is done so rendering gets the memory back."""
+    _get_pipeline.cache_clear()
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
 
 
+# the same files are read by several stages; callers must not mutate the result
+@lru_cache(maxsize=8)
 def load_json(path):
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return json_loads(f.read())
     except Exception as e:
         logging.error(f"Error loading {path}: {e}")
         return {}
 
-def remove_emojis(text):
-    return emoji.replace_emoji(text, replace='')
+# emoji with their variation selectors, keycaps and tag sequences, joined by
+# ZWJ; far cheaper than walking the emoji package's full table for every
+# message. The pictograph planes and the BMP code points that default to
+# emoji presentation always go; other symbols that have an emoji form
+# (e.g. ✓ ➜ ⌘ ⏎ © ™) stay plain unless U+FE0F asks for the emoji
+_EMOJI_WIDE    = "\U0001F000-\U0001FAFF"
+_EMOJI_BMP     = ("\u231A\u231B\u23E9-\u23EC\u23F0\u23F3\u25FD\u25FE\u2614\u2615"
+                  "\u2648-\u2653\u267F\u2693\u26A1\u26AA\u26AB\u26BD\u26BE\u26C4\u26C5"
+                  "\u26CE\u26D4\u26EA\u26F2\u26F3\u26F5\u26FA\u26FD\u2705\u270A\u270B"
+                  "\u2728\u274C\u274E\u2753-\u2755\u2757\u2795-\u2797\u27B0\u27BF"
+                  "\u2B1B\u2B1C\u2B50\u2B55")
+_EMOJI_SYMBOLS = ("\u00A9\u00AE\u203C\u2049\u2122\u2139\u2194-\u21AA\u2300-\u23FF\u24C2"
+                  "\u2600-\u27BF\u2B00-\u2BFF\u3030\u303D\u3297\u3299")
+_EMOJI_MODS    = "\uFE0E\uFE0F\u20E3\U000E0020-\U000E007F"
+_EMOJI = ("[0-9#*]\uFE0F?\u20E3"
+          f"|(?:[{_EMOJI_WIDE}{_EMOJI_BMP}]|[{_EMOJI_SYMBOLS}](?=\uFE0F))[{_EMOJI_MODS}]*"
+          f"(?:\u200D[{_EMOJI_WIDE}{_EMOJI_SYMBOLS}][{_EMOJI_MODS}]*)*"
+          f"|[{_EMOJI_MODS}]")
+
+# inline markers such as "[SFX:cough.wav]" (generate_image.py hides them from the
+# frames), markdown emphasis and emoji, all stripped together in one pass
+CLEAN_PATTERN = re.compile(
+    rf"(?P<sfx>\[SFX:(?P<file>[^\]]+)\])|(?P<md>\*\*\*|\*\*|\*|~~)|(?P<emoji>{_EMOJI})"
+)
 
-def remove_markdown(text):
-    return re.sub(r'(\*\*\*|\*\*|\*|~~)', '', text)
+# Kokoro's forward pass grows faster than linearly with input length, so long
+# messages are fed sentence by sentence rather than paragraph by paragraph
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
 
 def process_text_and_sfx(msg):
-    raw   = msg.get("text","")
-    clean = remove_emojis(remove_markdown(raw))
+    raw = msg.get("text","")
+
+    # inline markers fire at their relative position in the spoken text; the
+    # proportion is turned into an offset once the TTS duration is known
+    parts, markers, size, last = [], [], 0, 0
+    for m in CLEAN_PATTERN.finditer(raw):
+        chunk = raw[last:m.start()]
+        parts.append(chunk)
+        size += len(chunk)
+        if m.group("sfx"):
+            markers.append((m.group("file").strip(), size))
+        last = m.end()
+    parts.append(raw[last:])
+    clean = "".join(parts)
 
     sfx_evts = []
+    for file, pos in markers:
+        sfx_evts.append({
+            "file":       file,
+            "offset":     0.0,
+            "volume":     1.0,
+            "proportion": pos / len(clean) if clean else 0.0
+        })
     raw_sfx = msg.get("sfx", [])
     if isinstance(raw_sfx, dict):
         raw_sfx = [raw_sfx]
@@ -62,22 +165,210 @@ def process_text_and_sfx(msg):
         })
     return clean, sfx_evts
 
-def generate_tts(text, idx, voice):
-    """Generate a WAV via Kokoro and return (AudioClip, duration)."""
-    if not text:
-        return None, 0.0
-    os.makedirs(AUDIO_DIR, exist_ok=True)
-    out = os.path.join(AUDIO_DIR, f"tts_{idx}.wav")
+def generate_tts(texts, voice, paths, fp16=False):
+    """
+    Synthesize several texts with a single Kokoro call, streaming each text's
+    audio into its WAV in `paths` as the chunks arrive instead of holding and
+    concatenating them. Returns the number of samples written per text.
+    `fp16` runs the model under half-precision autocast (CUDA only).
+    """
+    pieces, owners = [], []
+    for i, text in enumerate(texts):
+        for piece in SENTENCE_SPLIT.split(text.strip()):
+            pieces.append(piece)
+            owners.append(i)
+
+    counts = [0] * len(texts)
+    out, current = None, None
+
+    # file work runs on one writer thread, in submission order, so disk
+    # I/O overlaps the next chunk's synthesis
+    def write(owner, chunk):
+        nonlocal out, current
+        if owner != current:
+            finish()
+            out = sf.SoundFile(paths[owner] + ".part", 'w', samplerate=24000, channels=1,
+                               format='WAV', subtype='PCM_16')
+            current = owner
+        out.write(chunk)
+
+    def finish():
+        nonlocal out
+        if out is not None:
+            out.close()
+            out = None
+            os.replace(paths[current] + ".part", paths[current])
+
+    import torch
+    autocast = (torch.autocast("cuda", dtype=torch.float16) if fp16 and tts_device() == "cuda"
+                else contextlib.nullcontext())
+    pipeline = _pipeline_with_voice(voice)
+    pending = []
     try:
-        gen   = pipeline(text, voice=voice, split_pattern=r'\n+')
-        parts = [audio for _, _, audio in gen]
-        combined = np.concatenate(parts) if parts else np.zeros(1, dtype=np.float32)
-        sf.write(out, combined, 24000)
-        clip = AudioFileClip(out)
-        return clip, clip.duration
+        with ThreadPoolExecutor(max_workers=1) as writer, torch.inference_mode(), autocast:
+            for result in pipeline(pieces, voice=voice):
+                if result.audio is None:
+                    continue
+                # text_index points back into `pieces`, whatever Kokoro chunked it
+                # into; chunks arrive in order, so each text's file is written in one go
+                owner = owners[result.text_index]
+                chunk = np.asarray(result.audio, dtype=np.float32)
+                pending.append(writer.submit(write, owner, chunk))
+                counts[owner] += len(chunk)
+            pending.append(writer.submit(finish))
+        for fut in pending:
+            fut.result()
+    finally:
+        # never leave a half-written file where the cache would pick it up
+        if out is not None:
+            out.close()
+            os.remove(paths[current] + ".part")
+    return counts
+
+def synthesize_batch(texts, voice, paths, fp16=False):
+    """
+    generate_tts for one batch, but a failure only silences the line that
+    caused it: the batch is retried text by text, keeping clips that were
+    finished before the error. Failed texts count 0 samples.
+    """
+    try:
+        return generate_tts(texts, voice, paths, fp16)
     except Exception as e:
-        logging.error(f"TTS error #{idx}: {e}")
-        return None, 0.0
+        logging.warning(f"TTS batch for voice {voice} failed ({e}); retrying line by line")
+    return synthesize_lines(texts, voice, paths, fp16)
+
+def synthesize_lines(texts, voice, paths, fp16=False):
+    """Synthesize texts one call each, reusing clips already on disk; failures count 0."""
+    counts = []
+    for text, path in zip(texts, paths):
+        try:
+            counts.append(sf.info(path).frames)  # written before the batch failed
+            continue
+        except Exception:
+            pass
+        try:
+            counts.extend(generate_tts([text], voice, [path], fp16))
+        except Exception as e:
+            logging.error(f"TTS error for voice {voice} on {text[:40]!r}: {e}")
+            counts.append(0)
+    return counts
+
+def _init_tts_worker(workers):
+    # split the cores between workers instead of letting each torch grab all of them
+    import torch
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+def default_tts_workers():
+    """
+    Processes used for TTS when --tts-workers is not given. Each one loads its
+    own copy of the model, so stay at a few workers with several torch threads
+    each rather than one single-threaded model per core.
+    """
+    # one model on the GPU already runs a batch in parallel; more processes
+    # would only load more copies into VRAM
+    if tts_device() != "cpu":
+        return 1
+    return min(4, max(1, (os.cpu_count() or 1) // 4))
+
+def synthesize_groups(groups, workers=None, fp16=False):
+    """
+    Yield (group, counts) for every (voice, jobs) group, running the groups in
+    parallel worker processes (each loads its own KPipeline) when there is
+    more than one. Speech is written to each job's cache path and lines that
+    fail count 0.
+    """
+    workers = workers or default_tts_workers()
+    if workers > 1 and groups:
+        # split big batches so even a single-voice conversation fills every worker
+        size   = -(-sum(len(group) for _, group in groups) // workers)
+        groups = [(voice, group[i:i+size]) for voice, group in groups
+                  for i in range(0, len(group), size)]
+    # never start a model copy without a batch to run
+    workers = min(len(groups), workers)
+    batches = [(voice, group, [job["text"] for job in group],
+                [tts_cache_path(job["text"], voice) for job in group])
+               for voice, group in groups]
+    if workers <= 1:
+        for voice, group, texts, paths in batches:
+            yield group, synthesize_batch(texts, voice, paths, fp16)
+        return
+
+    # workers start fresh interpreters: torch may already have touched the GPU
+    # here (CUDA cannot survive a fork), and the SFX prefetch and frame
+    # drawing threads may be holding locks a forked child would inherit
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_tts_worker,
+                             initargs=(workers,)) as ex:
+        futures = [(voice, group, texts, paths, ex.submit(synthesize_batch, texts, voice, paths, fp16))
+                   for voice, group, texts, paths in batches]
+        for voice, group, texts, paths, fut in futures:
+            try:
+                yield group, fut.result()
+            except Exception as e:
+                # the worker died (e.g. killed for memory), and a broken pool takes
+                # every shard still queued with it; finish those shards here
+                logging.error(f"TTS worker for voice {voice} failed ({e}); finishing its lines here")
+                yield group, synthesize_lines(texts, voice, paths, fp16)
+
+def tts_cache_path(text, voice):
+    # the language selects Kokoro's phonemizer, so it changes the audio too
+    key = hashlib.sha256(f"{LANG_CODE}\0{voice}\0{text}".encode()).hexdigest()
+    return os.path.join(TTS_CACHE_DIR, key + ".wav")
+
+def apply_tts(job, audio):
+    # speech is held as int16 until mixing: half the memory of float32
+    dur = len(audio) / 24000
+    job["frames"][0]["tts_audio"] = audio
+    marked = [e for e in job["frames"][0]["sfx_events"] if "proportion" in e]
+    if marked:
+        props   = np.fromiter((e["proportion"] for e in marked), dtype=np.float64, count=len(marked))
+        offsets = np.fromiter((e["offset"] for e in marked), dtype=np.float64, count=len(marked))
+        for e, start in zip(marked, (props * dur + offsets).tolist()):
+            e["offset"] = start
+    for frame in job["frames"]:
+        frame["duration"] = max(frame["duration"], dur)
+
+def attach_tts(jobs, workers=None, fp16=False):
+    """
+    Run every queued TTS job, one batch per voice, then hand each clip to the
+    first frame that speaks it and stretch all frames waiting on it.
+    Speech is cached on disk by (voice, text), so repeated lines and reruns
+    skip Kokoro entirely.
+    """
+    cached  = set(os.listdir(TTS_CACHE_DIR)) if os.path.isdir(TTS_CACHE_DIR) else set()
+    waiting = {}
+    for job in jobs:
+        waiting.setdefault(tts_cache_path(job["text"], job["voice"]), []).append(job)
+
+    by_voice = {}
+    for path, same in waiting.items():
+        if os.path.basename(path) in cached:
+            try:
+                audio, _ = sf.read(path, dtype="int16")
+                for job in same:
+                    apply_tts(job, audio)
+                continue
+            except Exception as e:
+                logging.warning(f"Ignoring unreadable TTS cache {path}: {e}")
+        # one job stands in for every identical line
+        by_voice.setdefault(same[0]["voice"], []).append(same[0])
+
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    spoken = 0
+    for group, counts in synthesize_groups(list(by_voice.items()), workers, fp16):
+        for job, count in zip(group, counts):
+            if not count:
+                continue
+            spoken += 1
+            path = tts_cache_path(job["text"], job["voice"])
+            audio, _ = sf.read(path, dtype="int16")
+            for same in waiting[path]:
+                apply_tts(same, audio)
+
+    # a broken model setup fails every line; don't render a silent video over it
+    if by_voice and not spoken:
+        logging.error("Speech synthesis failed for every line; aborting.")
+        sys.exit(1)
 
 def safe_duration(d):
     try:
@@ -85,56 +376,62 @@ def safe_duration(d):
     except:
         return 1.0
 
-def flatten_conversation(conv):
+def flatten_conversation(conv, tts_workers=None, fp16=False):
     """
     Mirrors your frame‑generator, but now:
     - speaks EVERY non-system text at the frame where it first appears,
     - retains system SFX but skips system TTS,
     - preserves full message+reaction sync.
+
+    Frames are laid out first and TTS is synthesized afterwards in one
+    batch per voice; each frame's duration is then raised to fit its speech.
     """
     cfg  = load_json(CONFIG_FILE)
-    default_voice = cfg.get("default", {}).get("voice_model", "af_heart")
+    default_cfg   = cfg.get("default", {})
+    default_voice = default_cfg.get("voice_model", "af_heart")
+    voice_by_role = {}
     flat = []
-    idx  = 1
+    jobs = []
     for entry in conv.get("conversation", []):
-        role     = entry.get("role", "unknown")
-        user_cfg = cfg.get(role, cfg.get("default", {}))
-        voice    = user_cfg.get("voice_model", default_voice)
+        role = entry.get("role", "unknown")
+        msgs = entry.get("messages", [])
 
         # --- SYSTEM MESSAGES: SFX only, no TTS ---
         if role == "system":
-            for msg in entry.get("messages", []):
+            for msg in msgs:
                 _, sys_sfx = process_text_and_sfx(msg)
                 dur = safe_duration(msg.get("duration", 1))
                 flat.append({
                     "duration":   dur,
-                    "tts_clip":   None,
+                    "tts_audio":  None,
                     "sfx_events": sys_sfx
                 })
-                idx += 1
             continue
 
-        msgs = entry.get("messages", [])
+        voice = voice_by_role.get(role)
+        if voice is None:
+            user_cfg = cfg.get(role, default_cfg)
+            voice    = voice_by_role[role] = user_cfg.get("voice_model", default_voice)
 
         # --- PREFIX FRAMES: each message[i] is shown alone on frame i+1 ---
         # now we TTS at that moment
-        for i in range(1, len(msgs)):
-            m = msgs[i-1]
+        for m in msgs[:-1]:
             clean, msg_sfx = process_text_and_sfx(m)
-            tts_clip, tts_dur = generate_tts(clean, idx, voice)
-            dur = max(safe_duration(m.get("duration",1)), tts_dur)
-            flat.append({
-                "duration":   dur,
-                "tts_clip":   tts_clip,
+            frame = {
+                "duration":   safe_duration(m.get("duration",1)),
+                "tts_audio":  None,
                 "sfx_events": msg_sfx
-            })
-            idx += 1
+            }
+            flat.append(frame)
+            # a message that was only emoji or SFX markers has nothing to say
+            if clean.strip():
+                jobs.append({"text": clean, "voice": voice, "frames": [frame]})
 
         # --- FULL MESSAGE + REACTIONS: for the last message only ---
         last = msgs[-1] if msgs else {}
         clean, last_sfx = process_text_and_sfx(last)
-        tts_clip, tts_dur = generate_tts(clean, idx, voice)
-        full_dur = max(safe_duration(last.get("duration",0)), tts_dur)
+        full_dur = safe_duration(last.get("duration",0))
+        full_frames = []
 
         reacts = entry.get("reactions", [])
         if reacts:
@@ -152,80 +449,394 @@ def flatten_conversation(conv):
                         "offset": float(e.get("offset",0.0)),
                         "volume": float(e.get("volume",1.0))
                     })
-                flat.append({
+                full_frames.append({
                     "duration":   full_dur,
-                    "tts_clip":   tts_clip if r_i==0 else None,
+                    "tts_audio":  None,
                     "sfx_events": evts
                 })
-                idx += 1
         else:
             # no reactions: single frame with TTS + all last‐msg SFX
-            flat.append({
+            full_frames.append({
                 "duration":   full_dur,
-                "tts_clip":   tts_clip,
+                "tts_audio":  None,
                 "sfx_events": last_sfx
             })
-            idx += 1
 
+        flat.extend(full_frames)
+        if clean.strip():
+            jobs.append({"text": clean, "voice": voice, "frames": full_frames})
+
+    # decode the SFX on a side thread while Kokoro is busy
+    with ThreadPoolExecutor(max_workers=1) as io:
+        prefetch = io.submit(prefetch_sfx, flat)
+        attach_tts(jobs, tts_workers, fp16)
+        prefetch.result()
     return flat
 
-def create_sfx_video(flat_list, output=OUTPUT_VIDEO):
+# H.264 encoders in order of preference: codec -> (preset, extra ffmpeg args)
+ENCODERS = {
+    "h264_nvenc":        ("p4",        ["-tune", "hq", "-rc", "vbr", "-cq", "23", "-b:v", "0", "-bf", "0"]),
+    "h264_qsv":          ("veryfast",  ["-global_quality", "23"]),
+    "h264_videotoolbox": ("medium",    ["-b:v", "4M"]),
+    "libx264":           ("ultrafast", ["-crf", "23", "-tune", "stillimage"]),
+}
+# moviepy only forces yuv420p for libx264; hardware encoders also need even sizes
+HW_PIXEL_ARGS = ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"]
+# move the moov atom to the front so players can start before the download ends
+FASTSTART = ["-movflags", "+faststart"]
+
+@lru_cache(maxsize=1)
+def pick_encoder():
+    """Return the most preferred encoder in ENCODERS that moviepy's ffmpeg can actually use."""
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    try:
+        listed = subprocess.run([ffmpeg, "-hide_banner", "-encoders"],
+                                capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return "libx264"
+    for codec in ENCODERS:
+        if codec == "libx264" or codec not in listed:
+            continue
+        # builds list hardware encoders even without the hardware, so try one
+        # frame; a driver that hangs counts as missing
+        try:
+            probe = subprocess.run(
+                [ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+                 "-i", "color=black:s=256x256:d=0.1", "-frames:v", "1",
+                 "-c:v", codec, "-f", "null", "-"],
+                capture_output=True, timeout=10
+            )
+        except subprocess.TimeoutExpired:
+            continue
+        if probe.returncode == 0:
+            return codec
+    return "libx264"
+
+# sample rate of the premixed soundtrack
+MIX_RATE = 44100
+
+def _resample(pcm, sr):
+    """
+    Band-limited resample to MIX_RATE. The spectrum is cut, or zero-padded,
+    at the new Nyquist frequency, so taking 48 kHz music down cannot alias and
+    upsampled speech gets no images.
+    """
+    if sr == MIX_RATE:
+        return pcm
+    step = sr // int(np.gcd(sr, MIX_RATE))
+    # pad with ~10 ms of silence against the FFT's wrap-around, to a length
+    # that maps onto a whole number of output samples
+    size = -(-(len(pcm) + sr // 100) // step) * step
+    out  = np.fft.irfft(np.fft.rfft(pcm, n=size, axis=0), n=size * MIX_RATE // sr, axis=0)
+    out *= MIX_RATE / sr
+    return out[:int(round(len(pcm) * MIX_RATE / sr))].astype(np.float32)
+
+def _as_stereo(pcm):
+    # mono becomes a single column that broadcasts over both output channels
+    if pcm.ndim == 1:
+        return pcm[:, None]
+    return pcm[:, :2]
+
+# decoded SFX stay cached for the run; prefetch_sfx warms the cache and
+# the mix threads share it
+@lru_cache(maxsize=128)
+def load_sfx(path):
+    """
+    Decode an SFX file to float32 at MIX_RATE, falling back to ffmpeg for
+    formats libsndfile lacks. The array is shared between events, so it is
+    returned read-only; scale a copy.
+    """
+    try:
+        pcm, sr = sf.read(path, dtype="float32")
+        pcm = _resample(pcm, sr)
+    except Exception:
+        cmd = [get_setting("FFMPEG_BINARY"), "-v", "error", "-i", path,
+               "-f", "f32le", "-ac", "2", "-ar", str(MIX_RATE), "-"]
+        raw = subprocess.run(cmd, capture_output=True, check=True).stdout
+        pcm = np.frombuffer(raw, dtype=np.float32).reshape(-1, 2).copy()
+    pcm.flags.writeable = False
+    return pcm
+
+@lru_cache(maxsize=1)
+def sfx_index():
+    """Every file under sfx/, listed once per run instead of a stat() per event."""
+    return frozenset(os.path.normpath(os.path.join(root, f))
+                     for root, _, files in os.walk("sfx", followlinks=True) for f in files)
+
+def sfx_exists(path):
+    # absolute names and paths leading out of sfx/ are not in the index
+    return os.path.normpath(path) in sfx_index() or os.path.exists(path)
+
+def prefetch_sfx(flat_list):
+    """Decode every SFX the frames reference ahead of mixing."""
+    paths = {os.path.join("sfx", s["file"]) for entry in flat_list for s in entry["sfx_events"]}
+    for path in sorted(paths):
+        if not sfx_exists(path):
+            continue
+        try:
+            load_sfx(path)
+        except Exception:
+            pass  # build_segment reports it when the SFX is mixed
+
+def _mix_into(master, pcm, start):
+    a = int(round(start * MIX_RATE))
+    if a < 0:
+        pcm, a = pcm[-a:], 0
+    n = min(len(pcm), len(master) - a)
+    if n > 0:
+        master[a:a+n] += pcm[:n]
+
+def build_segment(entry):
+    """
+    Premix one frame's speech and SFX. Returns (start, pcm): the stereo
+    segment and its offset in seconds from the frame start (negative when an
+    SFX leads the frame), or (0.0, None) if the frame is silent.
+    """
+    # one parallel array per field: sources, start offsets (s) and gains
+    pcms, offsets, volumes = [], [], []
+    if entry["tts_audio"] is not None:
+        speech = entry["tts_audio"].astype(np.float32)
+        speech *= 1 / 32768
+        pcms.append(_as_stereo(_resample(speech, 24000)))
+        offsets.append(0.0)
+        volumes.append(1.0)
+
+    for s in entry["sfx_events"]:
+        path = os.path.join("sfx", s["file"])
+        if sfx_exists(path):
+            try:
+                pcms.append(_as_stereo(load_sfx(path)))
+                offsets.append(s["offset"])
+                volumes.append(s["volume"])
+            except Exception as e:
+                logging.error(f"SFX load error {path}: {e}")
+        else:
+            logging.warning(f"Missing SFX: {path}")
+
+    if not pcms:
+        return 0.0, None
+    starts = np.round(np.asarray(offsets) * MIX_RATE).astype(np.int64)
+    first  = starts.min()
+    starts -= first
+    ends   = starts + np.fromiter((len(pcm) for pcm in pcms), dtype=np.int64, count=len(pcms))
+    seg    = np.zeros((int(ends.max()), 2), dtype=np.float32)
+    for pcm, a, b, vol in zip(pcms, starts, ends, volumes):
+        seg[a:b] += pcm if vol == 1.0 else pcm * vol
+    return first / MIX_RATE, seg
+
+def build_segments(flat_list, workers=None):
+    """Run build_segment over every frame, spread across threads when there are several cores."""
+    workers = min(len(flat_list), workers or os.cpu_count() or 1)
+    if workers <= 1:
+        return [build_segment(entry) for entry in flat_list]
+    # numpy releases the GIL for the adds and resampling, and threads share the
+    # SFX cache and return segments without pickling them; worker processes
+    # would re-import torch and Kokoro under spawn just to sum a few arrays
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(build_segment, flat_list))
+
+def mix_audio(flat_list, bg_music, durations, workers=None):
+    """
+    Premix every TTS line and SFX event into one stereo NumPy track, so the
+    render reads a single source instead of one ffmpeg decoder per clip.
+    Frames are premixed in parallel; only placing them on the track is serial.
+    Optional background music is layered on top. `durations` is the float64
+    array of frame lengths. Returns a (samples, 2) float32 array at MIX_RATE.
+    """
+    master = np.zeros((int(np.ceil(durations.sum() * MIX_RATE)), 2), dtype=np.float32)
+    # frame start times in one reduction rather than a running float sum
+    starts = np.zeros_like(durations)
+    np.cumsum(durations[:-1], out=starts[1:])
+    for begin, (start, seg) in zip(starts.tolist(), build_segments(flat_list, workers)):
+        if seg is not None:
+            _mix_into(master, seg, begin + start)
+
+    # optional background music, looped or cut to the video's length
+    if bg_music and os.path.exists(bg_music):
+        try:
+            bg = _as_stereo(load_sfx(bg_music))
+            # np.resize returns a fresh array, so the gain can go in place
+            bg = np.resize(bg, (len(master), bg.shape[1]))
+            bg *= 0.3
+            master += bg
+        except Exception as e:
+            logging.warning(f"BG music error: {e}")
+
+    np.clip(master, -1.0, 1.0, out=master)
+    return master
+
+def render_with_moviepy(frames, durations, audio, output, codec, preset, threads):
+    # PNG decoding happens in C with the GIL released, so threads overlap it
+    with ThreadPoolExecutor(max_workers=min(8, threads)) as ex:
+        clips = list(ex.map(lambda fd: ImageClip(fd[0]).set_duration(fd[1]),
+                            zip(frames, durations)))
+
+    # "chain" skips per-frame compositing but needs every frame to share one size
+    method = "chain" if len({c.size for c in clips}) == 1 else "compose"
+    final_vid = concatenate_videoclips(clips, method=method)
+    if audio is not None:
+        final_vid = final_vid.set_audio(AudioArrayClip(audio, fps=MIX_RATE))
+
+    params = ENCODERS[codec][1] + FASTSTART
+    if codec != "libx264":
+        params = params + HW_PIXEL_ARGS
+    logging.info(f"Encoding with {codec} ({preset})")
+    # frames are static slides: use every core and, for x264, tune for stills.
+    # No progress bar: it redraws per frame and the log lines already bracket the encode
+    final_vid.write_videofile(output, fps=24, codec=codec, audio_codec="aac",
+                              threads=threads, preset=preset,
+                              ffmpeg_params=params, logger=None)
+
+def _concat_path(path):
+    # quoting rules of ffmpeg's concat demuxer
+    return "'" + os.path.abspath(path).replace("'", "'\\''") + "'"
+
+def _canvas_size(frames):
+    """Largest frame size, rounded up to even for yuv420p."""
+    sizes = []
+    for path in frames:
+        with Image.open(path) as im:  # reads the header only
+            sizes.append(im.size)
+    W = max(w for w, _ in sizes)
+    H = max(h for _, h in sizes)
+    return W + W % 2, H + H % 2
+
+def _pad_filter(W, H):
+    # centre each frame on a black canvas, like moviepy's "compose" concatenation
+    return f"pad={W}:{H}:(ow-iw)/2:(oh-ih)/2:color=black,format=yuv420p"
+
+def _write_mix(audio):
+    mix_path = os.path.join(AUDIO_DIR, "mix.wav")
+    sf.write(mix_path, audio, MIX_RATE, subtype="PCM_16")
+    return mix_path
+
+def render_with_ffmpeg(frames, durations, audio, output, codec, preset, threads):
+    """
+    Hand the slideshow to ffmpeg's concat demuxer in a single process instead
+    of pushing every frame through moviepy. Frames are centred on a black
+    canvas of the largest frame size, like moviepy's "compose" concatenation.
+    """
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    listing = os.path.join(AUDIO_DIR, "frames.txt")
+    with open(listing, "w", encoding="utf-8") as f:
+        for path, dur in zip(frames, durations):
+            f.write(f"file {_concat_path(path)}\nduration {dur:.6f}\n")
+        # the demuxer drops the last duration unless the final file is repeated
+        f.write(f"file {_concat_path(frames[-1])}\n")
+
+    W, H = _canvas_size(frames)
+
+    cmd = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error",
+           "-f", "concat", "-safe", "0", "-i", listing]
+    if audio is not None:
+        cmd += ["-i", _write_mix(audio), "-c:a", "aac"]
+
+    logging.info(f"Encoding with {codec} ({preset})")
+    # frame rate is set on the output: an fps filter would lose its buffered
+    # frames whenever a differently sized frame reinitialises the filtergraph
+    cmd += ["-vf", _pad_filter(W, H), "-r", "24",
+            "-c:v", codec, "-preset", preset, *ENCODERS[codec][1],
+            "-threads", str(threads), "-t", f"{durations.sum():.3f}", *FASTSTART, output]
+    subprocess.run(cmd, check=True)
+
+def render_with_segments(frames, durations, audio, output, codec, preset, threads):
+    """
+    Encode every frame as its own video-only clip, cached by image content,
+    length and encoder settings, then join the clips with a stream copy and
+    mux the soundtrack once. Missing clips are encoded concurrently; reruns
+    only encode the frames that changed.
+    """
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    W, H   = _canvas_size(frames)
+    params = ENCODERS[codec][1]
+    settings = f"{W}x{H}\0{codec}\0{preset}\0{' '.join(params)}"
+
+    # cut on the 24 fps grid so the joined clips cannot drift from the audio
+    bounds = np.rint(np.concatenate(([0.0], np.cumsum(durations))) * 24).astype(np.int64)
+
+    os.makedirs(SEGMENT_CACHE_DIR, exist_ok=True)
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    listing = os.path.join(AUDIO_DIR, "segments.txt")
+    missing = {}
+    with open(listing, "w", encoding="utf-8") as f:
+        for path, count in zip(frames, np.diff(bounds)):
+            count = max(int(count), 1)
+            with open(path, "rb") as img:
+                key = hashlib.sha256(img.read())
+            key.update(f"\0{count}\0{settings}".encode())
+            seg = os.path.join(SEGMENT_CACHE_DIR, key.hexdigest() + ".mp4")
+            if not os.path.exists(seg):
+                missing[seg] = (path, count)
+            f.write(f"file {_concat_path(seg)}\n")
+
+    def encode(item):
+        seg, (path, count) = item
+        subprocess.run([ffmpeg, "-y", "-loglevel", "error",
+                        "-loop", "1", "-framerate", "24", "-i", path,
+                        "-frames:v", str(count), "-vf", _pad_filter(W, H),
+                        "-c:v", codec, "-preset", preset, *params,
+                        "-f", "mp4", seg + ".part"], check=True)
+        os.replace(seg + ".part", seg)
+
+    # short clips barely use x264's frame threads, so run a few side by side;
+    # hardware encoders cap concurrent sessions, keep those low
+    workers = min(threads, 8) if codec == "libx264" else 2
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(encode, missing.items()))
+    logging.info(f"Encoded {len(missing)} of {len(frames)} segments with {codec}")
+
+    cmd = [ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listing]
+    if audio is not None:
+        cmd += ["-i", _write_mix(audio), "-c:a", "aac"]
+    cmd += ["-c:v", "copy", *FASTSTART, output]
+    subprocess.run(cmd, check=True)
+
+def create_sfx_video(flat_list, output=OUTPUT_VIDEO, frames=None, renderer="ffmpeg", encoder=None,
+                     preset=None, threads=None):
+    """
+    Render the final video. `frames` may be a list of in-memory RGB arrays;
+    when omitted the PNGs written by generate_image.py are read from VIDEO_DIR.
+    `renderer` is "ffmpeg" (concat demuxer, needs frames on disk), "segments"
+    (like ffmpeg, but reuses cached per-frame encodes) or "moviepy".
+    `encoder` is a key of ENCODERS; by default the best working one is picked.
+    `preset` overrides the encoder's preset from ENCODERS and `threads` the
+    number of encoder threads (all cores by default).
+    """
     cfg      = load_json(CONFIG_FILE)
     bg_music = cfg.get("default", {}).get("background_music_path")
 
-    frames = sorted(glob.glob(os.path.join(VIDEO_DIR, "*.png")))
+    if frames is None:
+        frames = sorted(glob.glob(os.path.join(VIDEO_DIR, "*.png")))
     if not frames:
         logging.error("No frames found; aborting."); sys.exit(1)
     if len(frames)!=len(flat_list):
         logging.warning(f"{len(frames)} frames vs {len(flat_list)} audio entries; clipping.")
+    n = min(len(frames), len(flat_list))
+    frames, flat_list = frames[:n], flat_list[:n]
 
-    clips = []
-    cumulative = 0.0
-    audio_parts = []
-
-    for frame, entry in zip(frames, flat_list):
-        clip = ImageClip(frame).set_duration(entry["duration"])
-        clips.append(clip)
-
-        if entry["tts_clip"]:
-            audio_parts.append(entry["tts_clip"].set_start(cumulative))
-
-        for s in entry["sfx_events"]:
-            path = os.path.join("sfx", s["file"])
-            if os.path.exists(path):
-                try:
-                    sc = (AudioFileClip(path)
-                          .volumex(s["volume"])
-                          .set_start(cumulative + s["offset"]))
-                    audio_parts.append(sc)
-                except Exception as e:
-                    logging.error(f"SFX load error {path}: {e}")
-            else:
-                logging.warning(f"Missing SFX: {path}")
-
-        cumulative += entry["duration"]
-
-    final_vid = concatenate_videoclips(clips, method="compose")
-    if audio_parts:
-        final_vid = final_vid.set_audio(CompositeAudioClip(audio_parts))
-
-    # optional background music
-    if bg_music and os.path.exists(bg_music):
-        try:
-            bg = (AudioFileClip(bg_music)
-                  .volumex(0.3)
-                  .set_start(0)
-                  .set_duration(final_vid.duration))
-            final_vid = final_vid.set_audio(CompositeAudioClip([final_vid.audio, bg]))
-        except Exception as e:
-            logging.warning(f"BG music error: {e}")
+    # one contiguous column shared by the mixer and the renderers
+    durations = np.fromiter((entry["duration"] for entry in flat_list), dtype=np.float64, count=n)
+    audio = mix_audio(flat_list, bg_music, durations)
 
+    if renderer != "moviepy" and not all(isinstance(f, str) for f in frames):
+        logging.info("In-memory frames are rendered with moviepy")
+        renderer = "moviepy"
+
+    codec   = encoder or pick_encoder()
+    preset  = preset or ENCODERS[codec][0]
+    threads = threads or os.cpu_count() or 1
     os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
     try:
-        final_vid.write_videofile(output, fps=24, codec="libx264", audio_codec="aac", threads=4)
+        if renderer == "ffmpeg":
+            render_with_ffmpeg(frames, durations, audio, output, codec, preset, threads)
+        elif renderer == "segments":
+            render_with_segments(frames, durations, audio, output, codec, preset, threads)
+        else:
+            render_with_moviepy(frames, durations, audio, output, codec, preset, threads)
         logging.info(f"Final video created at {output}")
     except Exception as e:
-        logging.error(f"Render failed: {e}")
+        # keep the traceback: the message alone rarely says which step broke
+        logging.exception(f"Render failed: {e}")
         sys.exit(1)
 
 def main():
@@ -233,11 +844,42 @@ def main():
     p.add_argument("--conversation", default=CONV_FILE)
     p.add_argument("--output",       default=OUTPUT_VIDEO)
     p.add_argument("--cleanup",      action="store_true")
+    p.add_argument("--tts-workers",  type=int, default=None,
+                   help="Processes used for TTS, each with its own model copy; defaults to "
+                        "a quarter of the CPU count capped at 4, or 1 on a GPU")
+    p.add_argument("--fp16",         action="store_true",
+                   help="Run Kokoro in half precision (CUDA only)")
+    p.add_argument("--renderer",     choices=("ffmpeg", "segments", "moviepy"), default="ffmpeg",
+                   help="ffmpeg concat demuxer (fast, needs frames on disk), segments "
+                        "(ffmpeg with a per-frame encode cache, fastest on reruns) or moviepy")
+    p.add_argument("--encoder",      choices=list(ENCODERS), default=None,
+                   help="H.264 encoder; by default the first one in ENCODERS that works here")
+    p.add_argument("--preset",       default=None,
+                   help="Encoder preset, e.g. ultrafast..veryslow for libx264 or p1..p7 for "
+                        "h264_nvenc; defaults to the encoder's entry in ENCODERS")
+    p.add_argument("--threads",      type=int, default=None,
+                   help="Encoder threads; defaults to the CPU count")
+    p.add_argument("--render-frames", action="store_true",
+                   help="Render frames in-process instead of reading PNGs from the video directory")
     args = p.parse_args()
 
+    if args.fp16 and tts_device() != "cuda":
+        logging.warning(f"--fp16 needs CUDA; synthesizing in fp32 on {tts_device()}")
     conv = load_json(args.conversation)
-    flat = flatten_conversation(conv)
-    create_sfx_video(flat, args.output)
+    frames = None
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        if args.render_frames:
+            # skips the PNG encode/decode round-trip; run generate_image.py to inspect
+            # frames on disk. Frames only depend on the conversation, so they are
+            # drawn while Kokoro is still speaking
+            from generate_image import iter_frame_arrays
+            drawing = ex.submit(lambda: list(iter_frame_arrays(conv, load_json(CONFIG_FILE))))
+        flat = flatten_conversation(conv, args.tts_workers, args.fp16)
+        release_pipeline()
+        if args.render_frames:
+            frames = drawing.result()
+    create_sfx_video(flat, args.output, frames, args.renderer, args.encoder,
+                     args.preset, args.threads)
     if args.cleanup:
         for d in (AUDIO_DIR, VIDEO_DIR):
             shutil.rmtree(d, ignore_errors=True)
@@ -0,0 +1,130 @@
+# tests/test_sfx.py
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import sfx  # noqa: E402
+
+
+def clean(text):
+    return sfx.process_text_and_sfx({"text": text})[0]
+
+
+def test_emoji_are_stripped():
+    assert clean("hi 😀👍🏽 ok") == "hi  ok"
+    assert clean("fam 👨‍👩‍👧 and 🏳️‍⚧️") == "fam  and "
+    assert clean("on time ⌚ ⭐ ✅") == "on time   "
+
+
+def test_emoji_style_symbols_are_stripped():
+    # text-default symbols only become emoji with U+FE0F
+    assert clean("love ❤️ and ✔️") == "love  and "
+    assert clean("‼️ℹ️Ⓜ️㊗️〰️™️©️®️↔️ wow") == " wow"
+
+
+def test_keycaps_are_stripped():
+    assert clean("#️⃣ tag 1️⃣ one *⃣ star") == " tag  one  star"
+
+
+def test_plain_symbols_survive():
+    text = "Done ✓ not ✗, next ➜ press ⌘ ⏎ → ☺ ❤ © ™ ↔ #1 2"
+    assert clean(text) == text
+
+
+def test_blank_messages_queue_no_tts(monkeypatch):
+    queued = []
+    monkeypatch.setattr(sfx, "attach_tts", lambda jobs, *args: queued.extend(jobs))
+    conv = {"conversation": [{"role": "user", "messages": [
+        {"text": "😀 "}, {"text": "[SFX:ding.wav] "}, {"text": "hello 👋"},
+    ]}]}
+    flat = sfx.flatten_conversation(conv)
+    assert [job["text"] for job in queued] == ["hello "]
+    assert [frame["tts_audio"] for frame in flat] == [None, None, None]
+
+
+def test_sfx_outside_the_index_still_resolves(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "sfx").mkdir()
+    (tmp_path / "shared").mkdir()
+    (tmp_path / "shared" / "ding.wav").touch()
+    os.symlink(tmp_path / "shared", tmp_path / "sfx" / "linked")
+    sfx.sfx_index.cache_clear()
+    try:
+        assert os.path.join("sfx", "linked", "ding.wav") in sfx.sfx_index()
+        assert sfx.sfx_exists(os.path.join("sfx", str(tmp_path / "shared" / "ding.wav")))
+        assert sfx.sfx_exists(os.path.join("sfx", "..", "shared", "ding.wav"))
+        assert not sfx.sfx_exists(os.path.join("sfx", "missing.wav"))
+    finally:
+        sfx.sfx_index.cache_clear()
+
+
+# loads (and on first use downloads) the full Kokoro model, so it only runs on request
+@pytest.mark.skipif(not os.environ.get("KOKORO_TESTS"), reason="set KOKORO_TESTS=1 to run Kokoro")
+@pytest.mark.parametrize("fp16", [False, True])
+def test_kokoro_synthesizes_speech(tmp_path, fp16):
+    pytest.importorskip("kokoro")
+    if fp16 and sfx.tts_device() != "cuda":
+        pytest.skip("fp16 autocast needs CUDA")
+    path = str(tmp_path / "hello.wav")
+    try:
+        counts = sfx.generate_tts(["Hello there. How are you?"], "af_heart", [path], fp16)
+    finally:
+        sfx.release_pipeline()
+    assert counts[0] > 0
+    audio, rate = sfx.sf.read(path, dtype="int16")
+    assert rate == 24000 and len(audio) == counts[0] and audio.any()
+
+
+def test_failed_line_only_silences_itself(tmp_path, monkeypatch):
+    def fake_tts(texts, voice, paths, fp16=False):
+        for text, path in zip(texts, paths):
+            if text == "bad":
+                raise RuntimeError("G2P failed")
+            sfx.sf.write(path, [0.1] * 240, 24000, subtype="PCM_16")
+        return [240] * len(texts)
+    monkeypatch.setattr(sfx, "generate_tts", fake_tts)
+    paths = [str(tmp_path / f"{i}.wav") for i in range(3)]
+    assert sfx.synthesize_batch(["good", "bad", "fine"], "af_heart", paths) == [240, 0, 240]
+
+
+def test_all_lines_failing_aborts(tmp_path, monkeypatch):
+    monkeypatch.setattr(sfx, "TTS_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(sfx, "synthesize_groups",
+                        lambda groups, *args: ((group, [0] * len(group)) for _, group in groups))
+    jobs = [{"text": "hello", "voice": "af_heart", "frames": [{"duration": 1.0, "sfx_events": []}]}]
+    with pytest.raises(SystemExit):
+        sfx.attach_tts(jobs)
+
+
+def tone(freq, rate, seconds=0.5):
+    return sfx.np.sin(2 * sfx.np.pi * freq * sfx.np.arange(int(rate * seconds)) / rate)
+
+
+def rms(x):
+    return float(sfx.np.sqrt(sfx.np.mean(x ** 2)))
+
+
+def test_resample_keeps_audible_tones():
+    for rate in (24000, 48000):
+        out = sfx._resample(tone(1000, rate), rate)
+        assert len(out) == sfx.MIX_RATE // 2
+        assert abs(rms(out) - rms(tone(1000, sfx.MIX_RATE))) < 0.01
+
+
+def test_resample_does_not_alias():
+    # above the mix rate's Nyquist frequency: must vanish, not fold down to 21.1 kHz
+    out = sfx._resample(tone(23000, 48000), 48000)
+    assert rms(out) < 0.01
+
+
+def test_hung_encoder_probe_falls_back_to_libx264(monkeypatch):
+    def fake_run(cmd, **kwargs):
+        assert kwargs.get("timeout")
+        if "-encoders" in cmd:
+            return sfx.subprocess.CompletedProcess(cmd, 0, stdout=" ".join(sfx.ENCODERS))
+        raise sfx.subprocess.TimeoutExpired(cmd, kwargs["timeout"])
+    monkeypatch.setattr(sfx.subprocess, "run", fake_run)
+    assert sfx.pick_encoder() == "libx264"